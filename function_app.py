@@ -1,14 +1,22 @@
 import azure.functions as func
-import json
+import gzip
 import logging
 import os
+import re
+import sys
 import time
 import requests
+import ijson
+import orjson
+import msal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 from urllib3.util.retry import Retry
 from functools import lru_cache
 from threading import Lock
-from typing import Dict, Optional, Tuple
+from typing import Dict, NoReturn, Optional, Tuple
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -17,6 +25,29 @@ DEFAULT_PAGE_SIZE = 10
 DEFAULT_MAX_PAGES = 5
 MAX_PAGE_SIZE = 200000  # Maximum page size allowed
 MAX_PAGES_LIMIT = 0     # Maximum number of pages allowed (0 = unlimited)
+MAX_CONCURRENT_PAGE_FETCHES = 4  # Pages requested in parallel when pageIndex links and @odata.count are present
+RESPONSE_GZIP_LEVEL = 1          # Fastest gzip level; JSON still compresses well
+ERROR_BODY_LOG_LIMIT = 2048      # Bytes of an MDVM error body included in the logs
+
+# Endpoints and per-host connection pool sizes
+MDVM_API_BASE_URL = "https://api.securitycenter.microsoft.com"
+LOGIN_BASE_URL = "https://login.microsoftonline.com"
+MDVM_POOL_CONNECTIONS = 50
+MDVM_POOL_MAXSIZE = 100
+LOGIN_POOL_CONNECTIONS = 10
+LOGIN_POOL_MAXSIZE = 20
+TOKEN_REQUEST_TIMEOUT = 10  # Seconds allowed for each Entra ID request
+
+# Environment configuration, read once when the worker loads the function app
+_REQUIRED_ENV_VARS = ("AAD_TENANT_ID", "AAD_CLIENT_ID", "AAD_CLIENT_SECRET")
+_MISSING_ENV_VARS = [var for var in _REQUIRED_ENV_VARS if not os.environ.get(var)]
+if _MISSING_ENV_VARS:
+    logging.critical("Missing required environment variables: %s", ", ".join(_MISSING_ENV_VARS))
+    raise RuntimeError(f"Server misconfiguration: {', '.join(_MISSING_ENV_VARS)} missing")
+
+# (tenant_id, client_id, client_secret), in _REQUIRED_ENV_VARS order
+_AAD_CONFIG = tuple(os.environ[var] for var in _REQUIRED_ENV_VARS)
+_AAD_RESOURCE_APP_ID_URI = os.environ.get("AAD_RESOURCE_APP_ID_URI", "https://api.securitycenter.microsoft.com")
 
 # Global session with connection pooling and retry strategy
 def _get_http_session() -> requests.Session:
@@ -40,75 +71,133 @@ def _get_http_session() -> requests.Session:
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
+    # Dedicated pools per host: a large one for concurrent MDVM page fetches and a
+    # small one for the short-lived token calls, so neither evicts the other's connections
+    mdvm_adapter = HTTPAdapter(
+        max_retries=retry_strategy,
+        pool_connections=MDVM_POOL_CONNECTIONS,
+        pool_maxsize=MDVM_POOL_MAXSIZE
+    )
+    login_adapter = HTTPAdapter(
+        max_retries=retry_strategy,
+        pool_connections=LOGIN_POOL_CONNECTIONS,
+        pool_maxsize=LOGIN_POOL_MAXSIZE
+    )
+    
+    session.mount(MDVM_API_BASE_URL, mdvm_adapter)
+    session.mount(LOGIN_BASE_URL, login_adapter)
+    
     return session
 
 # Global session instance
 _http_session = _get_http_session()
 
-# Token caching
-_token_cache = {}
-_token_lock = Lock()
 
+class _TimeoutHttpClient:
+    """
+    MSAL http_client that forwards to a requests session with a default timeout.
+    MSAL only applies its own timeout= to the session it creates itself.
+    """
+    
+    def __init__(self, session: requests.Session, timeout: float):
+        self._session = session
+        self._timeout = timeout
+    
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.post(url, **kwargs)
+    
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.get(url, **kwargs)
+    
+    def close(self) -> None:
+        # The shared session outlives any single MSAL client
+        pass
 
-def _fetch_aad_token(tenant_id: str, client_id: str, client_secret: str, resource_app_id_uri: str) -> str:
-    """Acquire an Entra ID token using client credentials"""
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/token"
-    
-    data = {
-        "resource": resource_app_id_uri,
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "grant_type": "client_credentials"
-    }
+
+# Shared by all MSAL clients for token and authority discovery requests
+_token_http_client = _TimeoutHttpClient(_http_session, TOKEN_REQUEST_TIMEOUT)
+
+# Worker pool for concurrent page fetches (shares _http_session's connection pool)
+_page_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGE_FETCHES, thread_name_prefix="mdvm-page")
+_PAGE_INDEX_PATTERN = re.compile(r"([?&]pageIndex=)(\d+)")
+
+# (log message, error message) templates for MDVM HTTP errors, looked up by status code.
+# Templates are filled with {status_code} and {retry_after}.
+_MDVM_STATUS_ERRORS = {
+    401: ("Authentication failed - token may be expired", "Authentication failed. Token may be invalid or expired."),
+    403: ("Access denied - check API permissions", "Access denied. Check API permissions."),
+    429: ("Rate limit exceeded - retry after {retry_after} seconds", "Rate limit exceeded. Please retry after {retry_after} seconds."),
+    **{
+        status_code: (
+            "Server error {status_code} - temporary issue",
+            "MDVM API server error: API request failed with status {status_code}"
+        )
+        for status_code in range(500, 600)
+    },
+}
+_MDVM_UNEXPECTED_STATUS_ERROR = (
+    "Unexpected HTTP error: API request failed with status {status_code}",
+    "API request failed: API request failed with status {status_code}"
+)
+
+# Fields the columnar layout leaves out of the columns (they are the keys)
+_COLUMNAR_KEY_FIELDS = frozenset(("cveId", "osPlatform", "deviceName"))
+
+# Low-cardinality string fields repeated across many vulnerability rows
+_INTERNED_FIELDS = ("osPlatform", "deviceName", "softwareName", "severity")
+
+# MSAL clients live for the lifetime of the worker so their token cache is reused
+_confidential_clients: Dict[Tuple[str, str], msal.ConfidentialClientApplication] = {}
+_confidential_clients_lock = Lock()
+
+
+def _get_confidential_client(tenant_id: str, client_id: str, client_secret: str) -> msal.ConfidentialClientApplication:
+    """Get the MSAL client for this tenant/client pair, creating it on first use."""
+    cache_key = (tenant_id, client_id)
     
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-        "User-Agent": "MDVM-FuncApp/1.0"
-    }
+    confidential_client = _confidential_clients.get(cache_key)
+    if confidential_client is None:
+        with _confidential_clients_lock:
+            # Re-check under the lock in case another request created it first
+            confidential_client = _confidential_clients.get(cache_key)
+            if confidential_client is None:
+                confidential_client = msal.ConfidentialClientApplication(
+                    client_id,
+                    authority=f"{LOGIN_BASE_URL}/{tenant_id}",
+                    client_credential=client_secret,
+                    http_client=_token_http_client
+                )
+                _confidential_clients[cache_key] = confidential_client
+    
+    return confidential_client
+
 
+def _fetch_aad_token(tenant_id: str, client_id: str, client_secret: str, resource_app_id_uri: str) -> str:
+    """Acquire an Entra ID token using client credentials via MSAL (v2.0 endpoint)"""
     try:
-        response = _http_session.post(
-            token_url, 
-            data=data, 
-            headers=headers, 
-            timeout=10
-        )
-        response.raise_for_status()
-        payload = response.json()
+        confidential_client = _get_confidential_client(tenant_id, client_id, client_secret)
         
-        return payload["access_token"]
+        # MSAL serves the token from its own thread-safe cache until it nears expiry
+        result = confidential_client.acquire_token_for_client(scopes=[f"{resource_app_id_uri}/.default"])
         
-    except requests.exceptions.HTTPError as exc:
-        logging.error("Token request failed with status %s: %s", exc.response.status_code, exc.response.text)
-        raise RuntimeError("Failed to retrieve Entra ID token due to HTTP error.") from exc
     except requests.exceptions.RequestException as exc:
         logging.error("Token request failed due to connection error: %s", exc)
         raise RuntimeError("Failed to retrieve Entra ID token due to connection error.") from exc
-    except (KeyError, json.JSONDecodeError) as exc:
-        logging.error("Token response parsing failed: %s", exc)
-        raise RuntimeError("Failed to parse Entra ID token response.") from exc
-
-
-def _get_cached_token(tenant_id: str, client_id: str, client_secret: str, resource_app_id_uri: str) -> str:
-    """Get cached token or fetch new one if expired."""
-    cache_key = f"{tenant_id}:{client_id}:{resource_app_id_uri}"
-    
-    with _token_lock:
-        cached_entry = _token_cache.get(cache_key)
-        if cached_entry and cached_entry['expires_at'] > time.time() + 300:  # 5 min buffer
-            logging.info("Using cached token")
-            return cached_entry['token']
+    except ValueError as exc:
+        # Raised by MSAL for an invalid authority or an unparseable discovery response
+        logging.error("Token client initialization failed: %s", exc)
+        raise RuntimeError("Failed to initialize Entra ID token client.") from exc
     
-    # Fetch new token
-    token = _fetch_aad_token(tenant_id, client_id, client_secret, resource_app_id_uri)
+    if "access_token" not in result:
+        logging.error("Token request failed: %s - %s", result.get("error"), result.get("error_description"))
+        raise RuntimeError("Failed to retrieve Entra ID token.")
     
-    with _token_lock:
-        _token_cache[cache_key] = {
-            'token': token,
-            'expires_at': time.time() + 3600  # Assume 1 hour expiry
-        }
+    if result.get("token_source") == "cache":
+        logging.info("Using cached token")
     
-    return token
+    return result["access_token"]
 
 
 def _reorganize_vulnerabilities_by_hierarchy(vulnerabilities: list) -> dict:
@@ -118,31 +207,238 @@ def _reorganize_vulnerabilities_by_hierarchy(vulnerabilities: list) -> dict:
     """
     reorganized = {}
     
+    # Rows usually arrive clustered by platform and device, so keep the last
+    # buckets around and only go back to the dicts when either key changes
+    unset = object()
+    last_os_platform = last_device_name = unset
+    devices = cves = None
+    
     for vuln in vulnerabilities:
+        vuln_get = vuln.get
+        
         # Use correct field names from the actual API response
-        os_platform = vuln.get("osPlatform", "Unknown")
-        device_name = vuln.get("deviceName", "Unknown")
-        cve_id = vuln.get("cveId")
+        os_platform = vuln_get("osPlatform", "Unknown")
+        device_name = vuln_get("deviceName", "Unknown")
+        cve_id = vuln_get("cveId")
         
         # Handle cases where cveId might be null or empty
         if not cve_id:
             # Use a combination of software info to create a unique identifier
-            software_name = vuln.get("softwareName", "Unknown")
-            software_version = vuln.get("softwareVersion", "Unknown")
+            software_name = vuln_get("softwareName", "Unknown")
+            software_version = vuln_get("softwareVersion", "Unknown")
             cve_id = f"{software_name}_{software_version}"
         
-        # Use setdefault for cleaner nested dictionary creation
-        reorganized.setdefault(os_platform, {}).setdefault(device_name, {})[cve_id] = vuln
+        # Look up before inserting: setdefault(key, {}) would allocate a throwaway
+        # dict on every row even when the bucket already exists
+        if os_platform != last_os_platform:
+            last_os_platform = os_platform
+            last_device_name = unset
+            devices = reorganized.get(os_platform)
+            if devices is None:
+                devices = reorganized[os_platform] = {}
+        
+        if device_name != last_device_name:
+            last_device_name = device_name
+            cves = devices.get(device_name)
+            if cves is None:
+                cves = devices[device_name] = {}
+        
+        cves[cve_id] = vuln
     
     return reorganized
 
 
+def _reorganize_vulnerabilities_columnar(vulnerabilities: list) -> dict:
+    """
+    Reorganize vulnerabilities data into per-device columns in a single pass:
+    osPlatform -> deviceName -> {"shared": field -> value, "columns": field -> [value per CVE]}
+    Rows are keyed and de-duplicated by cveId exactly like the records layout. Fields
+    with the same value on every row of a device (deviceId, osVersion, ...) are stored
+    once under "shared"; osPlatform and deviceName are dropped since they are the keys.
+    """
+    reorganized = {}
+    
+    # Same last-bucket caching as the records layout; each device holds the row
+    # position of every cveId plus one list per field while the rows are collected
+    unset = object()
+    last_os_platform = last_device_name = unset
+    devices = positions = columns = None
+    
+    for vuln in vulnerabilities:
+        vuln_get = vuln.get
+        
+        os_platform = vuln_get("osPlatform", "Unknown")
+        device_name = vuln_get("deviceName", "Unknown")
+        cve_id = vuln_get("cveId")
+        
+        if not cve_id:
+            software_name = vuln_get("softwareName", "Unknown")
+            software_version = vuln_get("softwareVersion", "Unknown")
+            cve_id = f"{software_name}_{software_version}"
+        
+        if os_platform != last_os_platform:
+            last_os_platform = os_platform
+            last_device_name = unset
+            devices = reorganized.get(os_platform)
+            if devices is None:
+                devices = reorganized[os_platform] = {}
+        
+        if device_name != last_device_name:
+            last_device_name = device_name
+            device = devices.get(device_name)
+            if device is None:
+                device = devices[device_name] = ({}, {})
+            positions, columns = device
+        
+        row_count = len(positions)
+        position = positions.get(cve_id)
+        
+        if position is None:
+            positions[cve_id] = row_count
+            appended = 0
+            for field, value in vuln.items():
+                if field in _COLUMNAR_KEY_FIELDS:
+                    continue
+                column = columns.get(field)
+                if column is None:
+                    column = columns[field] = [None] * row_count
+                column.append(value)
+                appended += 1
+            
+            # Pad the fields this row does not have
+            if appended < len(columns):
+                for column in columns.values():
+                    if len(column) == row_count:
+                        column.append(None)
+        else:
+            # A repeated cveId replaces the earlier row in place, as in the records layout
+            for field, column in columns.items():
+                column[position] = vuln_get(field)
+            for field, value in vuln.items():
+                if field not in columns and field not in _COLUMNAR_KEY_FIELDS:
+                    columns[field] = [None] * row_count
+                    columns[field][position] = value
+    
+    for devices in reorganized.values():
+        for device_name, (positions, columns) in devices.items():
+            shared = {}
+            # cveId comes from the keys so the software-based fallback ids are kept
+            device_columns = {"cveId": list(positions)}
+            for field, column in columns.items():
+                if column.count(column[0]) == len(column):
+                    shared[field] = column[0]
+                else:
+                    device_columns[field] = column
+            
+            devices[device_name] = {"shared": shared, "columns": device_columns}
+    
+    return reorganized
+
+
+def _intern_repeated_fields(vulnerabilities: list) -> None:
+    """
+    Intern repeated string fields in place so rows share a single copy of each value.
+    This frees the per-row duplicates the parser creates and lets the hierarchy build
+    compare and hash the platform/device keys through the identity fast path.
+    """
+    intern = sys.intern
+    
+    for vuln in vulnerabilities:
+        for field in _INTERNED_FIELDS:
+            value = vuln.get(field)
+            if isinstance(value, str):
+                vuln[field] = intern(value)
+
+
+def _fetch_mdvm_page(url: str, headers: Dict[str, str], page_number: int) -> Tuple[list, Optional[str], Optional[int]]:
+    """Fetch and stream-parse a single MDVM page, returning its items, next link and @odata.count (if any)."""
+    page_start = time.time()
+    logging.info("Fetching page %d from MDVM API", page_number)
+    
+    # Stream the body so the page is parsed straight off the socket
+    with _http_session.get(
+        url, 
+        headers=headers, 
+        timeout=30,
+        stream=True
+    ) as response:
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as exc:
+            # Keep only the start of error bodies (they can be large HTML/JSON pages);
+            # rate-limit responses carry everything useful in Retry-After. The excerpt is
+            # logged by whoever consumes the error, so discarded prefetches stay silent.
+            if response.status_code != 429:
+                error_excerpt = response.raw.read(ERROR_BODY_LOG_LIMIT, decode_content=True)
+                exc.error_excerpt = error_excerpt.decode("utf-8", "replace")
+            raise
+        
+        response.raw.decode_content = True
+        
+        vulnerabilities = []
+        next_url = None
+        total_count = None
+        
+        # Single pass over the top-level keys: "value" holds the page items,
+        # "@odata.nextLink" (if present) points at the next page
+        for key, value in ijson.kvitems(response.raw, "", use_float=True):
+            if key == "value":
+                vulnerabilities = value
+            elif key == "@odata.nextLink":
+                next_url = value
+            elif key == "@odata.count":
+                total_count = value
+    
+    _intern_repeated_fields(vulnerabilities)
+    
+    page_duration = time.time() - page_start
+    logging.info("Page %d: %d vulnerabilities fetched in %.2fs", page_number, len(vulnerabilities), page_duration)
+    
+    return vulnerabilities, next_url, total_count
+
+
+def _build_page_url(template_url: str, match: re.Match, page_index: int) -> str:
+    """Build the URL of another page by replacing the pageIndex value matched in template_url."""
+    return f"{template_url[:match.start(2)]}{page_index}{template_url[match.end(2):]}"
+
+
+def _discard_page_fetches(in_flight: deque) -> None:
+    """
+    Cancel page fetches that are no longer needed and wait for any already running,
+    so no request outlives the invocation. Their results and errors are ignored.
+    """
+    for future in in_flight:
+        future.cancel()
+    wait(in_flight)
+    in_flight.clear()
+
+
+def _raise_mdvm_http_error(exc: requests.exceptions.HTTPError) -> NoReturn:
+    """Log an MDVM HTTP error and re-raise it as a RuntimeError with a client-facing message."""
+    response = exc.response
+    status_code = response.status_code
+    
+    error_excerpt = getattr(exc, "error_excerpt", None)
+    if error_excerpt is not None:
+        logging.error("MDVM API returned status %s: %s", status_code, error_excerpt)
+    
+    log_template, error_template = _MDVM_STATUS_ERRORS.get(status_code, _MDVM_UNEXPECTED_STATUS_ERROR)
+    fields = {
+        "status_code": status_code,
+        "retry_after": response.headers.get('Retry-After', '60')
+    }
+    
+    logging.error(log_template.format_map(fields))
+    raise RuntimeError(error_template.format_map(fields)) from exc
+
+
 def _fetch_mdvm_vulnerabilities(access_token: str, page_size: int = DEFAULT_PAGE_SIZE, max_pages: int = DEFAULT_MAX_PAGES) -> dict:
     """Fetch software vulnerabilities"""
-    base_url = "https://api.securitycenter.microsoft.com/api/machines/SoftwareVulnerabilitiesByMachine"
+    base_url = f"{MDVM_API_BASE_URL}/api/machines/SoftwareVulnerabilitiesByMachine"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
+        "Accept-Encoding": "gzip, br",
         "User-Agent": "MDVM-FuncApp/1.0"
     }
     
@@ -153,63 +449,93 @@ def _fetch_mdvm_vulnerabilities(access_token: str, page_size: int = DEFAULT_PAGE
     # Track performance metrics
     start_time = time.time()
     
-    while current_url and (max_pages == 0 or pages_fetched < max_pages):
-        page_start = time.time()
+    # Futures for consecutive pages that have been requested but not consumed yet
+    in_flight = deque()
+    
+    try:
+        # The first page is fetched on its own; its next link tells us whether the
+        # remaining pages can be requested ahead of time
+        vulnerabilities, current_url, total_count = _fetch_mdvm_page(current_url, headers, 1)
         
-        try:
-            logging.info(f"Fetching page {pages_fetched + 1} from MDVM API")
-            
-            response = _http_session.get(
-                current_url, 
-                headers=headers, 
-                timeout=30
-            )
-            response.raise_for_status()
-            
-            response_data = response.json()
-            page_duration = time.time() - page_start
-            
-            # Extract vulnerabilities from the current page
-            vulnerabilities = response_data.get("value", [])
-            all_vulnerabilities.extend(vulnerabilities)
+        # Pre-size the result when the API reports @odata.count, so appending pages
+        # fills existing slots instead of repeatedly growing the list. Without a
+        # count the list starts empty and the slice assignment simply appends.
+        if total_count:
+            expected_count = total_count if max_pages == 0 else min(total_count, max_pages * page_size)
+            all_vulnerabilities = [None] * expected_count
+        
+        all_vulnerabilities[:len(vulnerabilities)] = vulnerabilities
+        filled = len(vulnerabilities)
+        pages_fetched = 1
+        
+        # Pages are only requested ahead when the next link is addressed by pageIndex and
+        # @odata.count says how many pages exist, so nothing is requested past the end.
+        # Otherwise each next link is followed inline as soon as it has been seen.
+        page_index_match = _PAGE_INDEX_PATTERN.search(current_url) if current_url else None
+        fan_out = page_index_match is not None and bool(total_count) and len(vulnerabilities) >= page_size
+        if fan_out:
+            template_url = current_url
+            first_page_index = int(page_index_match.group(2))
+            total_pages = -(-total_count // page_size)
+        next_page_number = 2
+        
+        while current_url and (max_pages == 0 or pages_fetched < max_pages):
+            if fan_out:
+                depth = min(MAX_CONCURRENT_PAGE_FETCHES, total_pages - pages_fetched)
+                if in_flight or depth > 1:
+                    while len(in_flight) < depth and (max_pages == 0 or next_page_number <= max_pages):
+                        if in_flight:
+                            page_url = _build_page_url(
+                                template_url,
+                                page_index_match,
+                                first_page_index + next_page_number - 2
+                            )
+                        else:
+                            page_url = current_url
+                        
+                        in_flight.append(_page_executor.submit(_fetch_mdvm_page, page_url, headers, next_page_number))
+                        next_page_number += 1
             
-            logging.info(f"Page {pages_fetched + 1}: {len(vulnerabilities)} vulnerabilities fetched in {page_duration:.2f}s")
+            if in_flight:
+                vulnerabilities, current_url, _ = in_flight.popleft().result()
+            else:
+                vulnerabilities, current_url, _ = _fetch_mdvm_page(current_url, headers, pages_fetched + 1)
+                next_page_number = pages_fetched + 2
             
-            # Check for next page
-            current_url = response_data.get("@odata.nextLink")
+            all_vulnerabilities[filled:filled + len(vulnerabilities)] = vulnerabilities
+            filled += len(vulnerabilities)
             pages_fetched += 1
             
-        except requests.exceptions.HTTPError as exc:
-            status_code = exc.response.status_code
-            error_msg = f"API request failed with status {status_code}"
+            # Fewer rows than requested means the server caps the page size or the data
+            # changed, so the predicted URLs no longer line up: drop them and keep
+            # following the next link
+            if fan_out and len(vulnerabilities) < page_size:
+                fan_out = False
+                _discard_page_fetches(in_flight)
             
-            # Enhanced error handling based on status codes
-            if status_code == 401:
-                logging.error("Authentication failed - token may be expired")
-                raise RuntimeError("Authentication failed. Token may be invalid or expired.") from exc
-            elif status_code == 403:
-                logging.error("Access denied - check API permissions")
-                raise RuntimeError("Access denied. Check API permissions.") from exc
-            elif status_code == 429:
-                retry_after = exc.response.headers.get('Retry-After', '60')
-                logging.error(f"Rate limit exceeded - retry after {retry_after} seconds")
-                raise RuntimeError(f"Rate limit exceeded. Please retry after {retry_after} seconds.") from exc
-            elif 500 <= status_code < 600:
-                logging.error(f"Server error {status_code} - temporary issue")
-                raise RuntimeError(f"MDVM API server error: {error_msg}") from exc
-            else:
-                logging.error(f"Unexpected HTTP error: {error_msg}")
-                raise RuntimeError(f"API request failed: {error_msg}") from exc
-                
-        except requests.exceptions.RequestException as exc:
-            logging.error("API request failed due to connection error: %s", exc)
-            raise RuntimeError("Failed to connect to MDVM API.") from exc
+    except requests.exceptions.HTTPError as exc:
+        _raise_mdvm_http_error(exc)
+            
+    except (requests.exceptions.RequestException, Urllib3HTTPError) as exc:
+        # urllib3 errors can surface directly while streaming response.raw
+        logging.error("API request failed due to connection error: %s", exc)
+        raise RuntimeError("Failed to connect to MDVM API.") from exc
+    except ijson.JSONError as exc:
+        logging.error("MDVM API response parsing failed: %s", exc)
+        raise RuntimeError("Failed to parse MDVM API response.") from exc
+    finally:
+        # Fetches left over when an error (or a stale @odata.count) ends the loop are
+        # dropped without surfacing their errors
+        _discard_page_fetches(in_flight)
+    
+    # Drop unused slots if the data changed between pages and the count overshot
+    del all_vulnerabilities[filled:]
     
     total_duration = time.time() - start_time
-    logging.info(f"Total API fetch completed: {len(all_vulnerabilities)} vulnerabilities in {total_duration:.2f}s")
+    logging.info("Total API fetch completed: %d vulnerabilities in %.2fs", len(all_vulnerabilities), total_duration)
     
     if max_pages > 0 and pages_fetched >= max_pages and current_url:
-        logging.warning(f"Reached maximum page limit ({max_pages}). More data may be available.")
+        logging.warning("Reached maximum page limit (%d). More data may be available.", max_pages)
     
     return {
         "vulnerabilities": all_vulnerabilities,
@@ -220,6 +546,35 @@ def _fetch_mdvm_vulnerabilities(access_token: str, page_size: int = DEFAULT_PAGE
     }
 
 
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Check whether an Accept-Encoding header allows gzip. An explicit gzip entry wins over
+    a "*" wildcard, and a coding listed with q=0 is refused.
+    """
+    wildcard_allowed = False
+    
+    for coding in accept_encoding.lower().split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip()
+        if name not in ("gzip", "*"):
+            continue
+        
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        
+        if name == "gzip":
+            return quality > 0
+        wildcard_allowed = quality > 0
+    
+    return wildcard_allowed
+
+
 @app.route(route="getMDVMData")
 def getMDVMData(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Processing MDVM vulnerabilities request')
@@ -230,49 +585,51 @@ def getMDVMData(req: func.HttpRequest) -> func.HttpResponse:
         max_pages_input = max(int(req.params.get('maxPages', str(DEFAULT_MAX_PAGES))), 0)
         max_pages = min(max_pages_input, MAX_PAGES_LIMIT) if MAX_PAGES_LIMIT > 0 else max_pages_input
         reorganize = req.params.get('reorganize', 'true').lower() in ['true', '1', 'yes', 'on']
+        pretty = req.params.get('pretty', 'false').lower() in ['true', '1', 'yes', 'on']
+        columnar = req.params.get('layout', 'records').lower() == 'columnar'
     except ValueError as exc:
-        logging.warning(f"Invalid parameter values in request: {exc}")
+        logging.warning("Invalid parameter values in request: %s", exc)
         return func.HttpResponse(
-            json.dumps({"error": "pageSize and maxPages must be valid integers"}),
+            orjson.dumps({"error": "pageSize and maxPages must be valid integers"}),
             status_code=400,
             mimetype="application/json"
         )
 
-    # Environment configuration with validation
-    required_env_vars = ["AAD_TENANT_ID", "AAD_CLIENT_ID", "AAD_CLIENT_SECRET"]
-    env_config = {}
+    tenant_id, client_id, client_secret = _AAD_CONFIG
     
-    for var in required_env_vars:
-        value = os.environ.get(var)
-        if not value:
-            logging.error(f"Missing required environment variable: {var}")
-            return func.HttpResponse(
-                json.dumps({"error": f"Server misconfiguration: {var} is missing"}),
-                status_code=500,
-                mimetype="application/json"
-            )
-        env_config[var] = value
-    
-    resource_app_id_uri = os.environ.get("AAD_RESOURCE_APP_ID_URI", "https://api.securitycenter.microsoft.com")
-
     try:
-        # Use cached token
-        access_token = _get_cached_token(
-            env_config["AAD_TENANT_ID"],
-            env_config["AAD_CLIENT_ID"], 
-            env_config["AAD_CLIENT_SECRET"],
-            resource_app_id_uri
-        )
+        access_token = _fetch_aad_token(tenant_id, client_id, client_secret, _AAD_RESOURCE_APP_ID_URI)
         
         # Fetch vulnerabilities
         vulnerabilities_data = _fetch_mdvm_vulnerabilities(access_token, page_size, max_pages)
         
-        logging.info(f"Successfully fetched {vulnerabilities_data['total_count']} vulnerabilities across {vulnerabilities_data['pages_fetched']} pages")
+        logging.info(
+            "Successfully fetched %d vulnerabilities across %d pages",
+            vulnerabilities_data['total_count'],
+            vulnerabilities_data['pages_fetched']
+        )
         
         # Process response
         if reorganize and vulnerabilities_data['vulnerabilities']:
             logging.info("Reorganizing vulnerability data by OSPlatform -> DeviceName -> CveId hierarchy")
-            reorganized_data = _reorganize_vulnerabilities_by_hierarchy(vulnerabilities_data['vulnerabilities'])
+            if columnar:
+                reorganized_data = _reorganize_vulnerabilities_columnar(vulnerabilities_data['vulnerabilities'])
+            else:
+                reorganized_data = _reorganize_vulnerabilities_by_hierarchy(vulnerabilities_data['vulnerabilities'])
+            
+            # Display reorganized data structure summary (skip the walk when INFO is off)
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                device_count = 0
+                cve_count = 0
+                for devices in reorganized_data.values():
+                    device_count += len(devices)
+                    for device in devices.values():
+                        cve_count += len(device["columns"]["cveId"]) if columnar else len(device)
+                
+                logging.info(
+                    "Reorganized data structure: %d OS Platforms, %d unique devices, %d CVE entries",
+                    len(reorganized_data), device_count, cve_count
+                )
             
             # Create response with reorganized data and metadata
             response_data = {
@@ -283,30 +640,43 @@ def getMDVMData(req: func.HttpRequest) -> func.HttpResponse:
                     "has_more_data": vulnerabilities_data['has_more_data'],
                     "fetch_duration_seconds": vulnerabilities_data['fetch_duration_seconds'],
                     "reorganized": True,
-                    "structure": "osPlatform -> deviceName -> cveId"
+                    "layout": "columnar" if columnar else "records",
+                    "structure": (
+                        "osPlatform -> deviceName -> shared/columns -> field" if columnar
+                        else "osPlatform -> deviceName -> cveId"
+                    )
                 }
             }
             
-            # Display reorganized data structure summary
-            platform_count = len(reorganized_data)
-            device_count = sum(len(devices) for devices in reorganized_data.values())
-            cve_count = sum(len(cves) for devices in reorganized_data.values() for cves in devices.values())
-            
-            logging.info(f"Reorganized data structure: {platform_count} OS Platforms, {device_count} unique devices, {cve_count} CVE entries")
-            
         else:
             response_data = vulnerabilities_data
         
+        # Compact output by default; indentation is opt-in via ?pretty=true
+        json_options = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            json_options |= orjson.OPT_INDENT_2
+        
+        response_body = orjson.dumps(response_data, option=json_options, default=str)
+        logging.info("Serialized response: %d bytes (pretty=%s)", len(response_body), pretty)
+        
+        # Compress for clients that accept gzip
+        response_headers = {"Vary": "Accept-Encoding"}
+        if _accepts_gzip(req.headers.get("Accept-Encoding", "")):
+            response_body = gzip.compress(response_body, compresslevel=RESPONSE_GZIP_LEVEL)
+            response_headers["Content-Encoding"] = "gzip"
+            logging.info("Compressed response: %d bytes", len(response_body))
+        
         return func.HttpResponse(
-            json.dumps(response_data, indent=2, default=str),
+            response_body,
             status_code=200,
+            headers=response_headers,
             mimetype="application/json"
         )
         
     except RuntimeError as exc:
         logging.error("MDVM data fetch failed: %s", exc)
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "error": str(exc),
                 "timestamp": time.time()
             }),
@@ -316,7 +686,7 @@ def getMDVMData(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as exc:
         logging.exception("Unexpected error in getMDVMData")
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "error": "Internal server error",
                 "timestamp": time.time()
             }),